@@ -28,40 +28,39 @@ def main(args):
                     +"  If in IPython Notebook, click \'Interrupt Kernel\'.")
         sleep_time = args.sleep # seconds
         sleep_msg = ("INFO: Sleeping for {num} seconds.").format(num=sleep_time)
-        spe = read_spe.File(args.fpath)
-        #TODO: make open method in read_spe so that 'with open() as f' works to close file safely.
-        is_first_iter = True
-        while True:
-            # TODO: to run incrementally, reduce duplication between top-level main script
-            # and imorted modules.
-            # get num frames, get last frame, send to spe_process
-            num_frames = spe.get_num_frames()
-            if args.frame_end == -1:
-                args.frame_end = num_frames - 1
-            if not is_first_iter:
-                args.frame_start = frame_end_old
-                args.frame_end = num_frames - 1
-            try:
-                spe_process.main(args)
-                lc_online2.main(args)
-            # IndexError or ValueError can be raised by lc_online2 due to namespace conflicts with spe_process.
-            # TODO: Resolve namespace issues by sharing state info within modules using classes.
-            except IndexError:
-                spe_process.main(args)
-                lc_online2.main(args)
-            except ValueError:
-                spe_process.main(args)
-                lc_online2.main(args)
-            if args.verbose:
-                print(view_msg)
-                print(stop_msg)
-                print(sleep_msg)
-            time.sleep(sleep_time)
-            # Save variables from last iteration.
-            num_frames_old = num_frames
-            frame_start_old = args.frame_start
-            frame_end_old = args.frame_end
-            is_first_iter = False
+        with read_spe.File(args.fpath) as spe:
+            is_first_iter = True
+            while True:
+                # TODO: to run incrementally, reduce duplication between top-level main script
+                # and imorted modules.
+                # get num frames, get last frame, send to spe_process
+                num_frames = spe.get_num_frames(refresh=True)
+                if args.frame_end == -1:
+                    args.frame_end = num_frames - 1
+                if not is_first_iter:
+                    args.frame_start = frame_end_old
+                    args.frame_end = num_frames - 1
+                try:
+                    spe_process.main(args)
+                    lc_online2.main(args)
+                # IndexError or ValueError can be raised by lc_online2 due to namespace conflicts with spe_process.
+                # TODO: Resolve namespace issues by sharing state info within modules using classes.
+                except IndexError:
+                    spe_process.main(args)
+                    lc_online2.main(args)
+                except ValueError:
+                    spe_process.main(args)
+                    lc_online2.main(args)
+                if args.verbose:
+                    print(view_msg)
+                    print(stop_msg)
+                    print(sleep_msg)
+                time.sleep(sleep_time)
+                # Save variables from last iteration.
+                num_frames_old = num_frames
+                frame_start_old = args.frame_start
+                frame_end_old = args.frame_end
+                is_first_iter = False
     return None
 
 if __name__ == '__main__':
@@ -12,18 +12,47 @@ Note: Use with SPE 3.0. Not backwards compatible with SPE 2.X.
 """
 # TODO: make pytest modules with test_yes/no_footer.spe files
 # TODO: fix docstrings to match numpy style: https://github.com/numpy/numpy/blob/master/doc/example.py
-# TODO: remove pandas dependency. use builtin csv module.
 # TODO: Use logging levels (and warnings.warn) instead of print.
 
 
 from __future__ import absolute_import, division, print_function
 import argparse
+import collections
 import copy
+import csv
+import datetime
+import io
+import mmap
 import os
 import sys
-import StringIO
+import weakref
 import numpy as np
-import pandas as pd
+
+
+# A field from the binary header: byte offset, numpy type, and value read from the file.
+HeaderField = collections.namedtuple('HeaderField', ['offset', 'ntype', 'value'])
+
+
+def _parse_header_csv(ffmt):
+    """
+    Parse the SPE 3.0 header format CSV file.
+    Return a list of (binary, type_name, offset, description) tuples in file order.
+    Lines beginning with '#' are comments.
+    """
+    ffmt_base, ext = os.path.splitext(ffmt)
+    if not os.path.isfile(ffmt):
+        raise IOError("SPE 3.0 header format file does not exist: {fname}".format(fname=ffmt))
+    if ext != '.csv':
+        raise TypeError("SPE 3.0 header format file is not .csv: {fname}".format(fname=ffmt))
+    with open(ffmt, 'r') as fcsv:
+        header_format = [(row["Binary"], row["Type_Name"], int(row["Offset"]), row["Description"])
+                         for row in csv.DictReader(line for line in fcsv if not line.startswith('#'))]
+    return header_format
+
+
+# Header information from SPE 3.0 File Specification, Appendix A.
+# The format is static so parse it once on import.
+_HEADER_FORMAT = _parse_header_csv(os.path.join(os.path.dirname(__file__), 'spe_30_header_format.csv'))
 
 
 class File(object):
@@ -32,7 +61,6 @@ class File(object):
     """
     # TODO: Don't use protected keyword 'file' as class name.
     # Class-wide variables.
-    _bits_per_byte = 8
     # TODO: don't hardcode number of metadata, get from user or footer if it exists
     # Assuming metadata datatype is 64-bit signed integer
     # from XML footer metadata using previous experiments with LightField.
@@ -40,11 +68,6 @@ class File(object):
     _num_metadata = 3
     _metadata_ntype = np.int64
     _spe_30_required_offsets = [6, 18, 34, 42, 108, 656, 658, 664, 678, 1446, 1992, 2996, 4098]
-    _ntype_to_bits = {np.int8: 8, np.uint8: 8,
-                      np.int16: 16, np.uint16: 16,
-                      np.int32: 32, np.uint32: 32,
-                      np.int64: 64, np.uint64: 64,
-                      np.float32: 32, np.float64: 64}
     # Datatypes 6, 2, 1, 5 are for only SPE 2.X, not SPE 3.0.
     _datatype_to_ntype = {6: np.uint8, 3: np.uint16,
                           2: np.int16, 8: np.uint32,
@@ -56,22 +79,48 @@ class File(object):
                         "64s": np.int64, "64u": np.uint64,
                         "32f": np.float32, "64f": np.float64}
 
-    def __init__(self, fname):
+    def __init__(self, fname, use_memmap=True):
         """
         Initialize file.
         Open, load header and footer metadata, set current frame index.
+        If use_memmap is True, read frames through a memory map of the file.
+        Otherwise, seek and read each frame from the file object.
         """
         # For online analysis, read metadata from binary header.
         # For final reductions, read more complete metadata from XML footer.
         self._fname = fname
+        self._use_memmap = use_memmap
         self._check_spe()
         self._fid = open(fname, 'rb')
+        # Close the file if the object is garbage collected without being closed.
+        # weakref.finalize is only available for Python 3.4+.
+        if hasattr(weakref, 'finalize'):
+            self._finalizer = weakref.finalize(self, self._fid.close)
+        else:
+            self._finalizer = None
+        # File creation time does not change while the file is open.
+        self._file_ctime = os.path.getctime(fname)
+        self._eof_cached = None
         self._load_header_metadata()
+        self._load_frame_geometry()
         self._load_footer_metadata()
+        if self._use_memmap:
+            self._map_frames()
         self.current_frame_idx = 0
         return None
 
-    # TODO: make __del__ method to close file automatically.
+    def __enter__(self):
+        """
+        Return the file object for use in a 'with' statement.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Close the file on leaving a 'with' statement.
+        """
+        self.close()
+        return None
 
     def _check_spe(self):
         """
@@ -84,6 +133,14 @@ class File(object):
             raise IOError(("File extension not '.spe': {fname}").format(fname=self._fname))
         return None
     
+    def _check_open(self):
+        """
+        Check that the file has not been closed.
+        """
+        if self._fid.closed:
+            raise ValueError(("I/O operation on closed file: {fname}").format(fname=self._fname))
+        return None
+
     def _read_at(self, offset, size, ntype):
         """
         Seek to offset byte position then read size number of bytes in ntype format from file.
@@ -94,206 +151,266 @@ class File(object):
 
     def _load_header_metadata(self):
         """
-        Load SPE metadata from binary header into a pandas dataframe
+        Load SPE metadata from binary header into a dict keyed by field name
         and save as an object attribute.
         Use metadata from header for online analysis
         since XML footer does not yet exist while taking data.
-        Only the fields required for SPE 3.0 files are loaded. All other fields are numpy NaN.
+        Only the fields required for SPE 3.0 files are loaded. All other values are None.
         See SPE 3.0 File Format Specification:
         ftp://ftp.princetoninstruments.com/Public/Manuals/Princeton%20Instruments/
         SPE%203.0%20File%20Format%20Specification.pdf
         """
-        # TODO: don't remake temp file every time header metadata is needed.
         # file_header_ver and xml_footer_offset are
         # the only required header fields for SPE 3.0.
-        # Header information from SPE 3.0 File Specification, Appendix A.
-        # Remove comments from header CSV.
-        ffmt = os.path.join(os.path.dirname(__file__), 'spe_30_header_format.csv')
-        ffmt_base, ext = os.path.splitext(ffmt)
-        if not os.path.isfile(ffmt):
-            raise IOError("SPE 3.0 header format file does not exist: {fname}".format(fname=ffmt))
-        if ext != '.csv':
-            raise TypeError("SPE 3.0 header format file is not .csv: {fname}".format(fname=ffmt))
-        with open(ffmt, 'rb') as fcmts:
-            header_cmts = fcmts.readlines()
-        header_nocmts = []
-        for line in header_cmts:
-            if line.startswith('#'):
+        self._hdr = {}
+        for (binary, type_name, offset, description) in _HEADER_FORMAT:
+            # Field names of the x-axis and y-axis calibration structures are repeated.
+            # Keep the first occurrence. None of the repeated fields are required for SPE 3.0.
+            if type_name in self._hdr:
                 continue
-            else:
-                header_nocmts.append(line)
-        header_nocmts_str = StringIO.StringIO(''.join(header_nocmts))
-        self.header_metadata = pd.read_csv(header_nocmts_str, sep=',')
-        # TODO: Efficiently read values and create column following
-        # http://pandas.pydata.org/pandas-docs/version/0.13.1/cookbook.html
-        # Index values by offset byte position.
-        offset_to_value = {}
-        for idx in xrange(len(self.header_metadata)):
-            offset = int(self.header_metadata["Offset"][idx])
-            try:
-                size = (self.header_metadata["Offset"][idx+1]
-                        - self.header_metadata["Offset"][idx]
-                        - 1)
-            # Key error if at last value in the header
-            except KeyError:
-                size = 1
-            ntype = File._binary_to_ntype[self.header_metadata["Binary"][idx]]
-            offset_to_value[offset] = self._read_at(offset, size, ntype)
+            self._hdr[type_name] = HeaderField(offset=offset,
+                                               ntype=File._binary_to_ntype[binary],
+                                               value=None)
         # Store only the values for the byte offsets required of SPE 3.0 files.
         # Read only first element of these values since for files written by LightField,
         # other elements and values from offets are 0.
-        nan_array = np.empty(len(self.header_metadata))
-        nan_array[:] = np.nan
-        self.header_metadata["Value"] = pd.DataFrame(nan_array)
-        for offset in File._spe_30_required_offsets:
-            tf_mask = (self.header_metadata["Offset"] == offset)
-            self.header_metadata["Value"].loc[tf_mask] = offset_to_value[offset][0]
+        # Read the header once and interpret each required field from the buffer.
+        required = [(type_name, field) for (type_name, field) in self._hdr.items()
+                    if field.offset in File._spe_30_required_offsets]
+        header_size = max(field.offset + np.dtype(field.ntype).itemsize
+                          for (type_name, field) in required)
+        self._fid.seek(0)
+        buf = self._fid.read(header_size)
+        for (type_name, field) in required:
+            value = np.frombuffer(buf, dtype=field.ntype, count=1, offset=field.offset)[0]
+            self._hdr[type_name] = field._replace(value=value)
         # Check for SPE 3.0
-        tf_mask = (self.header_metadata["Type_Name"] == "file_header_ver")
-        version = self.header_metadata[tf_mask]["Value"].values[0]
+        version = self._hdr["file_header_ver"].value
         if version != 3:
             print(("WARNING: File is not SPE version 3.\n"
                    +" SPE version: {ver}").format(ver=version), file=sys.stderr)
         return None
-    
+
+    def get_header_metadata(self):
+        """
+        Return SPE metadata from binary header as a pandas dataframe
+        with columns Binary, Type_Name, Offset, Description, Value,
+        one row per field of the header format in file order.
+        Only the fields required for SPE 3.0 files have values. All other values are numpy NaN.
+        """
+        # Import pandas only when a dataframe is requested.
+        import pandas as pd
+        # Index values by offset byte position since field names of the calibration structures are repeated.
+        offset_to_value = {field.offset: field.value for field in self._hdr.values()
+                           if field.value is not None}
+        records = [(binary, type_name, offset, description, offset_to_value.get(offset, np.nan))
+                   for (binary, type_name, offset, description) in _HEADER_FORMAT]
+        return pd.DataFrame.from_records(records, columns=["Binary", "Type_Name", "Offset", "Description", "Value"])
+
     def _load_footer_metadata(self):
         """
-        Load SPE metadata from XML footer as a string
+        Load the byte offset of the SPE metadata XML footer
         and save as an object attribute.
-        Use metadata from footer for final reductions
-        since XML footer is more complete.
+        The footer is read and parsed only when first requested.
         """
-        tf_mask = (self.header_metadata["Type_Name"] == "XMLOffset")
-        xml_offset = int(self.header_metadata[tf_mask]["Value"].values[0])
-        if xml_offset == 0:
+        self._footer_offset = int(self._hdr["XMLOffset"].value)
+        self._footer_xml = None
+        self._footer_metadata = None
+        self._footer_tree = None
+        if self._footer_offset == 0:
             print(("INFO: XML footer metadata is empty for:\n"
                   +" {fname}").format(fname=self._fname))
-        else:
+        return None
+
+    def _read_footer_xml(self):
+        """
+        Return SPE metadata from XML footer as bytes.
+        Return None if the file has no XML footer.
+        The footer is read from the file once then cached.
+        """
+        if self._footer_xml is None and self._footer_offset != 0:
             # All XML footer metadata is contained within one line.
             # Strip anything before '<SpeFormat' or after 'SpeFormat>'
             # The byte offset for the start of the XML file can be off if the file
             # is not begun/ended correctly. Search for the beginning of the XML
             # footer 1KB before the byte offset and trim the excess.
-            self._fid.seek(xml_offset - 1024)
+            self._fid.seek(self._footer_offset - 1024)
             xml_orig = self._fid.read()
             xml_trim = copy.copy(xml_orig)
-            pieces = xml_trim.partition('<SpeFormat')
-            xml_trim = ''.join(pieces[1:])
-            pieces = xml_trim.rpartition('SpeFormat>')
-            xml_trim = ''.join(pieces[:-1])
-            if xml_trim == '':
+            pieces = xml_trim.partition(b'<SpeFormat')
+            xml_trim = b''.join(pieces[1:])
+            pieces = xml_trim.rpartition(b'SpeFormat>')
+            xml_trim = b''.join(pieces[:-1])
+            if xml_trim == b'':
                 print(("WARNING: XML footer was not partitioned correctly\n" +
                        "and may need to be reformatted."), file=sys.stderr)
-                xml = xml_orig
+                self._footer_xml = xml_orig
             else:
-                xml = xml_trim
-            self.footer_metadata = xml
-        return None
+                self._footer_xml = xml_trim
+        return self._footer_xml
+
+    def get_footer_metadata(self):
+        """
+        Return SPE metadata from XML footer as a string.
+        Return None if the file has no XML footer.
+        Use metadata from footer for final reductions
+        since XML footer is more complete.
+        """
+        if self._footer_metadata is None:
+            xml = self._read_footer_xml()
+            if xml is not None:
+                # The file is read as bytes. Decode to text as for Python 2 and 3 alike.
+                # Bytes from frames preceding an incorrectly partitioned footer are replaced.
+                self._footer_metadata = xml.decode('utf-8', 'replace')
+        return self._footer_metadata
 
+    def footer_xpath(self, expr, ns=None):
+        """
+        Evaluate an XPath expression on the XML footer and return the result.
+        Return None if the file has no XML footer.
+        ns maps namespace prefixes used in expr to namespace URIs, e.g.
+        {'spe': 'http://www.princetoninstruments.com/spe/2009'}.
+        The footer is parsed on first use and the tree is cached.
+        """
+        # Import lxml only when the XML footer is parsed.
+        from lxml import etree
+        if self._footer_tree is None:
+            xml = self._read_footer_xml()
+            if xml is None:
+                return None
+            self._footer_tree = etree.fromstring(xml)
+        return self._footer_tree.xpath(expr, namespaces=ns)
+
+    def iter_footer(self, tag):
+        """
+        Yield elements with the given tag from the XML footer without building the whole tree.
+        Give the tag with its namespace, e.g.
+        '{http://www.princetoninstruments.com/spe/2009}DataFormat'.
+        Each yielded element is a copy that the caller can keep.
+        """
+        # Import lxml only when the XML footer is parsed.
+        from lxml import etree
+        xml = self._read_footer_xml()
+        if xml is None:
+            return
+        for (event, elt) in etree.iterparse(io.BytesIO(xml), events=('end',)):
+            if elt.tag == tag:
+                yield copy.deepcopy(elt)
+            # Keep elements within a match until the match itself has been copied.
+            if next(elt.iterancestors(tag), None) is not None:
+                continue
+            # Free the parsed element and all preceding siblings
+            # so that only the path to the current element remains in the tree.
+            elt.clear()
+            while elt.getprevious() is not None:
+                del elt.getparent()[0]
+
+    def _load_frame_geometry(self):
+        """
+        Compute frame and per-frame metadata sizes from the binary header metadata
+        and save as object attributes.
+        The header does not change after the file is created so the sizes are only computed once.
+        """
+        # TODO: use footer metadata if it exists.
+        # Start of all data is 2 bytes past the last value in the header.
+        self._start_offset = int(self._hdr["lastvalue"].offset + 2)
+        self._xdim = int(self._hdr["xdim"].value)
+        self._ydim = int(self._hdr["ydim"].value)
+        self._pixels_per_frame = int(self._xdim * self._ydim)
+        pixel_datatype = self._hdr["datatype"].value
+        self._pixel_ntype = File._datatype_to_ntype[pixel_datatype]
+        # Infer frame size.
+        # From SPE 3.0 File Format Specification, Ch 1 (with clarifications):
+        # bytes_per_frame = pixels_per_frame * bytes_per_pixel
+        # Use integer arithmetic throughout so that sizes are exact for large frames.
+        self._bytes_per_frame = self._pixels_per_frame * np.dtype(self._pixel_ntype).itemsize
+        # From SPE 3.0 File Format Specification, Ch 1 (with clarifications):
+        # bytes_per_metadata_elt = 8 bytes per metadata element
+        #   metadata element includes time stamps, frame tracking number, etc with 8 bytes each.
+        self._bytes_per_metadata_elt = np.dtype(File._metadata_ntype).itemsize
+        self._bytes_per_metadata_set = File._num_metadata * self._bytes_per_metadata_elt
+        self._bytes_per_stride = self._bytes_per_frame + self._bytes_per_metadata_set
+        self._num_frames_cached = None
+        return None
 
     def _get_start_offset(self):
         """
         Return offset byte position of start of all data.
         """
-        # TODO: use footer metadata if it exists.
-        tf_mask = (self.header_metadata["Type_Name"] == "lastvalue")
-        start_offset = int(self.header_metadata[tf_mask]["Offset"].values[0] + 2)
-        return start_offset
+        return self._start_offset
 
-    def _get_eof_offset(self):
+    def _get_eof_offset(self, refresh=False):
         """
         Return end-of-file byte position.
+        The position is read once then cached.
+        If refresh is True, read the position again, e.g. if the file is being written to by LightField.
         """
         # TODO: use footer metadata if it exists.
-        self._fid.seek(0, 2)
-        eof_offset = int(self._fid.tell())
-        return eof_offset
+        # Use the file size rather than seeking to the end, which discards the file object's read buffer.
+        if refresh or self._eof_cached is None:
+            self._eof_cached = int(os.fstat(self._fid.fileno()).st_size)
+        return self._eof_cached
 
     def _get_xdim(self):
         """
         Return number of pixels along frame x-axis.
         """
-        # TODO: use footer metadata if it exists
-        tf_mask = (self.header_metadata["Type_Name"] == "xdim")
-        xdim = int(self.header_metadata[tf_mask]["Value"].values[0])
-        return xdim
+        return self._xdim
 
     def _get_ydim(self):
         """
         Return number of pixels along frame y-axis.
         """
-        # TODO: use footer metadata if it exists
-        tf_mask = (self.header_metadata["Type_Name"] == "ydim")
-        ydim = int(self.header_metadata[tf_mask]["Value"].values[0])
-        return ydim
+        return self._ydim
 
     def _get_pixels_per_frame(self):
         """
         Return number of pixels per frame.
         """
-        # TODO: use footer metadata if it exists.
-        xdim = self._get_xdim()
-        ydim = self._get_ydim()
-        pixels_per_frame = int(xdim * ydim)
-        return pixels_per_frame
+        return self._pixels_per_frame
 
     def _get_pixel_ntype(self):
         """
         Return pixel binary data type as numpy type.
         """
-        # TODO: use footer metadata if it exists.
-        tf_mask = (self.header_metadata["Type_Name"] == "datatype")
-        pixel_datatype = self.header_metadata[tf_mask]["Value"].values[0]
-        pixel_ntype = File._datatype_to_ntype[pixel_datatype]
-        return pixel_ntype
+        return self._pixel_ntype
 
     def _get_bytes_per_frame(self):
         """
         Return number of bytes per frame.
         """
-        # TODO: use footer metadata if it exists.
-        # Infer frame size.
-        # From SPE 3.0 File Format Specification, Ch 1 (with clarifications):
-        # bytes_per_frame = pixels_per_frame * bits_per_pixel / (8 bits per byte)
-        pixels_per_frame = self._get_pixels_per_frame()
-        pixel_ntype = self._get_pixel_ntype()
-        bits_per_pixel = File._ntype_to_bits[pixel_ntype]
-        bytes_per_frame = int(pixels_per_frame * (bits_per_pixel / File._bits_per_byte))
-        return bytes_per_frame
+        return self._bytes_per_frame
 
     def _get_bytes_per_metadata_elt(self):
         """
         Return number of bytes per element of metadata.
         """
-        # TODO: use footer metadata if it exists.
-        # From SPE 3.0 File Format Specification, Ch 1 (with clarifications):
-        # bytes_per_metadata_elt = 8 bytes per metadata element
-        #   metadata element includes time stamps, frame tracking number, etc with 8 bytes each.
-        bits_per_metadata_elt = File._ntype_to_bits[File._metadata_ntype]
-        bytes_per_metadata_elt = int(bits_per_metadata_elt / File._bits_per_byte)
-        return bytes_per_metadata_elt
+        return self._bytes_per_metadata_elt
 
     def _get_bytes_per_metadata_set(self):
         """
         Return number of bytes per set of metadata elements.
         """
-        bytes_per_metadata_elt = self._get_bytes_per_metadata_elt()
-        bytes_per_metadata_set = int(File._num_metadata * bytes_per_metadata_elt)
-        return bytes_per_metadata_set
+        return self._bytes_per_metadata_set
 
     def _get_bytes_per_stride(self):
         """
         Return number of bytes per frame + per-frame metadata.
         Equivalent to the number of bytes to move to the beginning of the next frame.
         """
-        bytes_per_frame = self._get_bytes_per_frame()
-        bytes_per_metadata_set = self._get_bytes_per_metadata_set()
-        bytes_per_stride = int(bytes_per_frame + bytes_per_metadata_set)
-        return bytes_per_stride
-        
-    def get_num_frames(self):
+        return self._bytes_per_stride
+
+    def get_file_ctime(self):
+        """
+        Return file creation time in seconds since epoch, Jan 1 1970 UTC.
+        """
+        return self._file_ctime
+
+    def get_num_frames(self, refresh=False):
         """
         Return number of frames currently in an SPE file.
+        The number of frames is counted once then cached.
+        If refresh is True, recount the frames, e.g. if the file is being written to by LightField.
         """
         # TODO: use footer metadata if it exists.
         # Infer the number of frames that have been taken using the file size in bytes.
@@ -302,95 +419,238 @@ class File(object):
         # not the number of frames that have already been taken and are in the file being read.
         # In case the file is currently being written to by LightField
         # when the file is being read by Python, count only an integer number of frames.
-        # Allow negative indexes using mod.
+        if refresh or self._num_frames_cached is None:
+            eof_offset = self._get_eof_offset(refresh=refresh)
+            self._num_frames_cached = int((eof_offset - self._start_offset) // self._bytes_per_stride)
+        return self._num_frames_cached
+
+    def _map_frames(self):
+        """
+        Memory-map the frames and per-frame metadata currently in the file.
+        Frames are viewed as a numpy structured array with one record per frame
+        and fields 'pixels' (2D array) and 'metadata' (1D array of 64-bit integers).
+        Call again to remap if the file has grown, e.g. while LightField is writing to it.
+        """
+        num_frames = self.get_num_frames()
         start_offset = self._get_start_offset()
         bytes_per_stride = self._get_bytes_per_stride()
-        eof_offset = self._get_eof_offset()
-        num_frames = int((eof_offset - start_offset) // bytes_per_stride)
-        return num_frames
-                
+        pixel_ntype = self._get_pixel_ntype()
+        xdim = self._get_xdim()
+        ydim = self._get_ydim()
+        frame_dtype = np.dtype([('pixels', pixel_ntype, (ydim, xdim)),
+                                ('metadata', File._metadata_ntype, (File._num_metadata,))])
+        self._frame_mm = np.memmap(self._fname, dtype=np.uint8, mode='r')
+        self._frames = np.ndarray(shape=(num_frames,), dtype=frame_dtype,
+                                  buffer=self._frame_mm, offset=start_offset,
+                                  strides=(bytes_per_stride,))
+        # Frames are usually read in order, so have the kernel read ahead.
+        self._advise_frames('MADV_SEQUENTIAL')
+        self._read_one = self._make_reader()
+        return None
+
+    def _make_reader(self):
+        """
+        Return a function that reads a frame and per-frame metadata by frame index
+        from the memory map of the file.
+        The function returns the same as _read_frame_at and is specialized once
+        so that no per-frame field lookups are needed.
+        Rebuild the function whenever the file is remapped.
+        The function does not reference the File object so that the object is not in a reference cycle.
+        """
+        # Bind the field views once. The frame dtype and shape are fixed by the memory map.
+        pixels = self._frames['pixels']
+        metadata_set = self._frames['metadata']
+        def read_frame(frame_idx):
+            # Copy the frame so that it does not hold a reference to the memory map.
+            (mtsexpstart, mtsexpend, mftracknum) = metadata_set[frame_idx]
+            return (pixels[frame_idx].copy(), mtsexpstart, mtsexpend, mftracknum)
+        return read_frame
+
+    def _advise_frames(self, option, start=None, length=None):
+        """
+        Advise the kernel how the memory map of the file will be accessed.
+        option is the name of an mmap module constant, e.g. 'MADV_SEQUENTIAL'.
+        start and length are in bytes from the beginning of the file.
+        If they are None, advise for the whole file.
+        Advice is skipped where unsupported, e.g. Python < 3.8 or Windows.
+        """
+        mm = getattr(self._frame_mm, '_mmap', None)
+        if not hasattr(mm, 'madvise') or not hasattr(mmap, option):
+            return None
+        if start is None:
+            mm.madvise(getattr(mmap, option))
+        else:
+            # madvise requires the start to be aligned to a page boundary.
+            page_start = start - (start % mmap.PAGESIZE)
+            length = min(length + (start - page_start), len(mm) - page_start)
+            mm.madvise(getattr(mmap, option), page_start, length)
+        return None
+
+    def _read_frame_at(self, frame_idx):
+        """
+        Seek to and read a frame and per-frame metadata from the file object.
+        Return frame as a numpy 2D array followed by the per-frame metadata elements.
+        frame_idx must be non-negative and less than the number of frames in the file.
+        """
+        # Infer frame and per-frame metadata offsets.
+        start_offset = self._get_start_offset()
+        bytes_per_stride = self._get_bytes_per_stride()
+        frame_offset = start_offset + (frame_idx * bytes_per_stride)
+        bytes_per_frame = self._get_bytes_per_frame()
+        metadata_offset = frame_offset + bytes_per_frame
+        bytes_per_metadata_elt = self._get_bytes_per_metadata_elt()
+        pixels_per_frame = self._get_pixels_per_frame()
+        pixel_ntype = self._get_pixel_ntype()
+        frame = self._read_at(frame_offset, pixels_per_frame, pixel_ntype)
+        xdim = self._get_xdim()
+        ydim = self._get_ydim()
+        frame = frame.reshape((ydim, xdim))
+        mtsexpstart_offset = metadata_offset
+        mtsexpend_offset = mtsexpstart_offset + bytes_per_metadata_elt
+        mftracknum_offset = mtsexpend_offset + bytes_per_metadata_elt
+        mtsexpstart = self._read_at(mtsexpstart_offset, 1, File._metadata_ntype)[0]
+        mtsexpend   = self._read_at(mtsexpend_offset, 1, File._metadata_ntype)[0]
+        mftracknum  = self._read_at(mftracknum_offset, 1, File._metadata_ntype)[0]
+        return (frame, mtsexpstart, mtsexpend, mftracknum)
+
     def get_frame(self, frame_idx):
         """
         Return a frame and per-frame metadata from the file.
         Frame is returned as a numpy 2D array.
         Time stamp metadata is returned as Python datetime object.
         frame_idx argument is python indexed: 0 is first frame.
+        Raise ValueError if the file has been closed.
         """
+        self._check_open()
         # See SPE 3.0 File Format Specification:
         # ftp://ftp.princetoninstruments.com/Public/Manuals/Princeton%20Instruments/
         # SPE%203.0%20File%20Format%20Specification.pdf
         # If XML footer metadata exists (i.e. for final reductions).
-        if hasattr(self, 'footer_metadata'):
+        if self._footer_offset != 0:
             # TODO: complete as below
             pass
         # Else use binary header metadata (i.e. for online analysis).
         # else:
         # Get the number of frames currently in the file.
         # Update the index position of the frame last read.
+        # Allow negative indexes using mod.
+        # Recount the frames if the index is past the last frame counted
+        # or counts back from the last frame,
+        # e.g. if LightField has written more frames since the last count.
         num_frames = self.get_num_frames()
+        if frame_idx < 0 or frame_idx >= num_frames:
+            num_frames = self.get_num_frames(refresh=True)
         self.current_frame_idx = int(frame_idx % num_frames)
-        # Infer frame and per-frame metadata offsets.
-        start_offset = self._get_start_offset()
-        bytes_per_stride = self._get_bytes_per_stride()
-        frame_offset = start_offset + (self.current_frame_idx * bytes_per_stride)
-        bytes_per_frame = self._get_bytes_per_frame()
-        metadata_offset = frame_offset + bytes_per_frame
-        bytes_per_metadata_elt = self._get_bytes_per_metadata_elt()
         # Read frame, metadata. Format metadata timestamps to be absolute time, UTC.
         # Time_stamps from the ProEM's internal timer-counter card are in 1E6 ticks per second.
         # Ticks per second from XML footer metadata using previous LightField experiments:
         # 1 tick = 1 microsecond ; 1E6 ticks per second.
         # 0 ticks is when "Acquire" was first clicked on LightField.
-        pixels_per_frame = self._get_pixels_per_frame()
-        pixel_ntype = self._get_pixel_ntype()
-        frame = self._read_at(frame_offset, pixels_per_frame, pixel_ntype)
-        xdim = self._get_xdim()
-        ydim = self._get_ydim()
-        frame = frame.reshape((ydim, xdim))
-        mtsexpstart_offset = metadata_offset
-        mtsexpend_offset = mtsexpstart_offset + bytes_per_metadata_elt
-        mftracknum_offset = mtsexpend_offset + bytes_per_metadata_elt
+        if self._use_memmap:
+            # Remap if frames were added to the file since it was last mapped.
+            if self.current_frame_idx >= len(self._frames):
+                self._map_frames()
+            (frame, mtsexpstart, mtsexpend, mftracknum) = self._read_one(self.current_frame_idx)
+        else:
+            (frame, mtsexpstart, mtsexpend, mftracknum) = self._read_frame_at(self.current_frame_idx)
         metadata = {}
-        mtsexpstart = self._read_at(mtsexpstart_offset, 1, File._metadata_ntype)[0]
-        mtsexpend   = self._read_at(mtsexpend_offset, 1, File._metadata_ntype)[0]
-        mftracknum  = self._read_at(mftracknum_offset, 1, File._metadata_ntype)[0]
         metadata["time_stamp_exposure_started"] = mtsexpstart
         metadata["time_stamp_exposure_ended"] = mtsexpend
         metadata["frame_tracking_number"] = mftracknum
         return (frame, metadata)
 
-    # # TODO: make generator. for now use get_frame
-    # def get_frames(self, frame_idx_list):
-    #     """
-    #     Yield a frame and per-frame metadata from the file.
-    #     Return a frame and per-frame metadata from the file.
-    #     Frame is returned as a numpy 2D array.
-    #     Time stamp metadata is returned as Python datetime object.
-    #     frame_list argument is python indexed: 0 is first frame.
-    #     """
-    #     # get_num_frames()
-    #     # self.current_frame_idx
-    #     for fnum in frame_idx_list:
-    #         print(fnum)
-    #     return None
+    def get_frames(self, frame_idx_list, chunk=64):
+        """
+        Yield frames and per-frame metadata from the file in chunks of up to chunk frames.
+        Frames are yielded as a numpy 3D array with shape (frames_in_chunk, ydim, xdim).
+        Metadata is yielded as a dict of numpy 1D arrays with one element per frame.
+        Time stamps are yielded both as ticks and as absolute time, UTC, in numpy datetime64 arrays.
+        frame_idx_list argument is python indexed: 0 is first frame.
+        Raise IndexError if frames are requested from a file with no frames.
+        Raise ValueError if the file has been closed.
+        """
+        self._check_open()
+        # Allow negative indexes using mod.
+        # Recount the frames if an index is past the last frame counted
+        # or counts back from the last frame,
+        # e.g. if LightField has written more frames since the last count.
+        frame_idxs = np.asarray(frame_idx_list, dtype=np.int64)
+        if len(frame_idxs) == 0:
+            return
+        num_frames = self.get_num_frames()
+        if frame_idxs.min() < 0 or frame_idxs.max() >= num_frames:
+            num_frames = self.get_num_frames(refresh=True)
+        if num_frames == 0:
+            raise IndexError(("File has no frames: {fname}").format(fname=self._fname))
+        frame_idxs = frame_idxs % num_frames
+        if self._use_memmap and num_frames > len(self._frames):
+            self._map_frames()
+        # Time_stamps from the ProEM's internal timer-counter card are in 1E6 ticks per second.
+        # 1 tick = 1 microsecond ; 1E6 ticks per second.
+        # 0 ticks is when "Acquire" was first clicked on LightField.
+        # Without footer metadata, assume "Acquire" was clicked when the .SPE file was created.
+        # Note: Only relevant for online analysis. Not accurate for reductions.
+        # Convert the file creation time as spe_process does so that time stamps are consistent.
+        dt_fctime_abs = np.datetime64(datetime.datetime.utcfromtimestamp(self._file_ctime), 'us')
+        # Have the kernel read ahead if frames are read in order, otherwise not to.
+        # Advice for out-of-order reads is reset when the generator finishes or is closed
+        # so that later reads from the file still read ahead.
+        is_in_order = bool(np.all(np.diff(frame_idxs) >= 0))
+        if self._use_memmap and not is_in_order:
+            self._advise_frames('MADV_RANDOM')
+        try:
+            for start in range(0, len(frame_idxs), chunk):
+                chunk_idxs = frame_idxs[start:start+chunk]
+                if self._use_memmap:
+                    # Prefetch the next chunk while this chunk is being processed.
+                    # Only prefetch contiguous frames so that frames between sparse indexes are not read.
+                    next_idxs = frame_idxs[start+chunk:start+2*chunk]
+                    if (is_in_order and len(next_idxs) > 0
+                        and int(next_idxs[-1]) - int(next_idxs[0]) + 1 == len(next_idxs)):
+                        self._advise_frames('MADV_WILLNEED',
+                                            start=self._start_offset + int(next_idxs[0]) * self._bytes_per_stride,
+                                            length=len(next_idxs) * self._bytes_per_stride)
+                    # Fancy indexing copies the records out of the memory map.
+                    records = self._frames[chunk_idxs]
+                    frames = records['pixels']
+                    metadata_set = records['metadata']
+                else:
+                    reads = [self._read_frame_at(frame_idx) for frame_idx in chunk_idxs]
+                    frames = np.array([read[0] for read in reads])
+                    metadata_set = np.array([read[1:] for read in reads], dtype=File._metadata_ntype)
+                self.current_frame_idx = int(chunk_idxs[-1])
+                metadata = {}
+                metadata["time_stamp_exposure_started"] = metadata_set[:, 0]
+                metadata["time_stamp_exposure_ended"] = metadata_set[:, 1]
+                metadata["frame_tracking_number"] = metadata_set[:, 2]
+                metadata["datetime_exposure_started"] = dt_fctime_abs + metadata_set[:, 0].astype('timedelta64[us]')
+                metadata["datetime_exposure_ended"] = dt_fctime_abs + metadata_set[:, 1].astype('timedelta64[us]')
+                yield (frames, metadata)
+        finally:
+            if self._use_memmap and not is_in_order:
+                self._advise_frames('MADV_SEQUENTIAL')
 
     def close(self):
         """
-        Close file.
+        Close file and release the memory map.
         """
+        self._read_one = None
+        self._frames = None
+        self._frame_mm = None
         self._fid.close()
+        if self._finalizer is not None:
+            self._finalizer.detach()
         return None
 
 def main(args):
     """
     Read a numbered frame from the SPE file.
-    Show a plot and print the metadata.
+    Return the frame and the metadata.
     """
-    fid = File(args.fname)
-    (frame, metadata) = fid.get_frame(args.frame_idx)
-    fid.close()
+    with File(args.fname) as fid:
+        (frame, metadata) = fid.get_frame(int(args.frame_idx))
     return (frame, metadata)
-            
+
 if __name__ == "__main__":
     # TODO: have defaults for metadata
     fname_default = "test_yes_footer.spe"
@@ -402,8 +662,12 @@ if __name__ == "__main__":
                               +"Default: {default}".format(default=fname_default)))
     parser.add_argument("--frame_idx",
                         default=frame_idx_default,
+                        type=int,
                         help=("Frame index to read in. First frame is 0. Last frame is -1. "
                               +"Default: {default}".format(default=frame_idx_default)))
+    parser.add_argument("--plot",
+                        action='store_true',
+                        help=("Show a plot of the frame. Requires matplotlib."))
     parser.add_argument("--verbose",
                         "-v",
                         action='store_true',
@@ -414,4 +678,10 @@ if __name__ == "__main__":
         for arg in args.__dict__:
             print(arg, args.__dict__[arg])
     (frame, metadata) = main(args)
+    for key in sorted(metadata):
+        print(key, metadata[key])
+    if args.plot:
+        import matplotlib.pyplot as plt
+        plt.imshow(frame, interpolation='none')
+        plt.show()
     
@@ -318,7 +318,7 @@ def main(args):
         # File creation time is in seconds since epoch, Jan 1 1970 UTC.
         # Note: Only relevant for online analysis. Not accurate for reductions.
         if is_first_iter:
-            dt_fctime_abs = dt.datetime.utcfromtimestamp(os.path.getctime(args.fpath))
+            dt_fctime_abs = dt.datetime.utcfromtimestamp(spe.get_file_ctime())
         ticks_per_second = 1000000.
         expstart_rel_sec = metadata["time_stamp_exposure_started"] / ticks_per_second
         # Convert ticks from ProEM to seconds since timer-counter card in ProEM
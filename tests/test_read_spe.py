@@ -6,21 +6,302 @@
 
 
 from __future__ import absolute_import, division, print_function
+import datetime
+import gc
+import glob
 import sys
+import weakref
 sys.path.insert(0, '.')
+from astropy.io import fits
+import numpy as np
+import pytest
 import read_spe
 
 
+# SPE files with one FITS file per frame exported by LightField, named '<fname_base>-Frame-<N>.fits'.
+fnames_spe_with_fits = ['tests/data/test_bias 2014-05-20 22_00_21.spe',
+                        'tests/data/test_dark_10s 2014-05-20 21_49_21.spe',
+                        'tests/data/test_dark_20s 2014-05-20 21_45_44.spe',
+                        'tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe']
+
+
+def test_read_spe_get_header_metadata(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe'):
+    """pytest style test for read_spe.File.get_header_metadata
+
+    """
+    header_metadata = read_spe.File(fname=fname_spe).get_header_metadata()
+    assert len(header_metadata) == len(read_spe._HEADER_FORMAT)
+    assert list(header_metadata.columns) == ["Binary", "Type_Name", "Offset", "Description", "Value"]
+    # Field names of the calibration structures are repeated but the required field names are unique.
+    name_to_value = dict(zip(header_metadata["Type_Name"], header_metadata["Value"]))
+    assert name_to_value["xdim"] == 162
+    assert name_to_value["ydim"] == 127
+    assert name_to_value["datatype"] == 3
+    assert np.isnan(name_to_value["ControllerVersion"])
+    return None
+
+
 def test_read_spe_load_footer_metadata(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe',
                                        xml_first_40=r'<SpeFormat version="3.0" xmlns="http://w',
                                        xml_last_40=r'39Z" /></GeneralInformation></SpeFormat>'):
-    """pytest style test for read_spe.File._load_footer_metadata
+    """pytest style test for read_spe.File._load_footer_metadata and read_spe.File.get_footer_metadata
 
     """
-    footer_metadata = read_spe.File(fname=fname_spe).footer_metadata
+    footer_metadata = read_spe.File(fname=fname_spe).get_footer_metadata()
     assert footer_metadata[:40] == xml_first_40
     assert footer_metadata[-40:] == xml_last_40
     return None
 
 
+def test_read_spe_get_footer_metadata_no_footer(fname_spe='tests/data/test_lightbox_10s_no_footer 2014-05-20 21_56_08.spe'):
+    """pytest style test for read_spe.File.get_footer_metadata
+
+    """
+    assert read_spe.File(fname=fname_spe).get_footer_metadata() is None
+    return None
+
+
+def test_read_spe_footer_xpath(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe',
+                               ns={'spe': 'http://www.princetoninstruments.com/spe/2009'}):
+    """pytest style test for read_spe.File.footer_xpath
+
+    """
+    spe = read_spe.File(fname=fname_spe)
+    assert spe.footer_xpath('//spe:DataBlock[@type="Frame"]/@count', ns=ns) == ['5']
+    assert spe.footer_xpath('//spe:DataBlock[@type="Frame"]/@stride', ns=ns) == ['41172']
+    return None
+
+
+def test_read_spe_get_frame(fnames_spe=fnames_spe_with_fits):
+    """pytest style test for read_spe.File.get_frame with and without a memory map
+
+    """
+    for fname_spe in fnames_spe:
+        fnames_fits = sorted(glob.glob(fname_spe.replace('.spe', '-Frame-*.fits')))
+        spe_mm = read_spe.File(fname=fname_spe, use_memmap=True)
+        spe_fid = read_spe.File(fname=fname_spe, use_memmap=False)
+        assert spe_mm.get_num_frames() == len(fnames_fits)
+        for (frame_idx, fname_fits) in enumerate(fnames_fits):
+            # FITS data from LightField has shape (1, ydim, xdim).
+            frame_fits = fits.getdata(fname_fits)[0]
+            (frame_mm, metadata_mm) = spe_mm.get_frame(frame_idx)
+            (frame_fid, metadata_fid) = spe_fid.get_frame(frame_idx)
+            assert np.array_equal(frame_mm, frame_fits)
+            assert np.array_equal(frame_fid, frame_fits)
+            assert frame_mm.dtype == frame_fid.dtype
+            assert metadata_mm == metadata_fid
+        # Negative index -1 is the last frame.
+        (frame_mm, metadata_mm) = spe_mm.get_frame(-1)
+        (frame_fid, metadata_fid) = spe_fid.get_frame(-1)
+        assert np.array_equal(frame_mm, fits.getdata(fnames_fits[-1])[0])
+        assert np.array_equal(frame_fid, frame_mm)
+        assert metadata_mm == metadata_fid
+        assert metadata_mm == spe_mm.get_frame(len(fnames_fits) - 1)[1]
+        spe_mm.close()
+        spe_fid.close()
+    return None
+
+
+def test_read_spe_get_frames(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe',
+                             frame_idx_list=[4, 0, -1, 2, 7, 1, 3], chunk=3):
+    """pytest style test for read_spe.File.get_frames with and without a memory map
+
+    """
+    for use_memmap in [True, False]:
+        spe = read_spe.File(fname=fname_spe, use_memmap=use_memmap)
+        num_frames = spe.get_num_frames()
+        chunks = list(spe.get_frames(frame_idx_list, chunk=chunk))
+        assert [len(frames) for (frames, metadata) in chunks] == [3, 3, 1]
+        frames = np.concatenate([frames for (frames, metadata) in chunks])
+        assert frames.shape == (len(frame_idx_list), spe._get_ydim(), spe._get_xdim())
+        # Negative and out-of-range indexes wrap around as for get_frame.
+        for (frame_num, frame_idx) in enumerate(frame_idx_list):
+            (chunk_num, chunk_idx) = divmod(frame_num, chunk)
+            (frame, metadata) = spe.get_frame(frame_idx)
+            assert np.array_equal(frames[frame_num], frame)
+            for key in metadata:
+                assert chunks[chunk_num][1][key].shape == (len(chunks[chunk_num][0]),)
+                assert chunks[chunk_num][1][key][chunk_idx] == metadata[key]
+        assert spe.current_frame_idx == frame_idx_list[-1] % num_frames
+        assert list(spe.get_frames([])) == []
+        spe.close()
+    return None
+
+
+def test_read_spe_get_frames_prefetch(monkeypatch,
+                                      fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe',
+                                      frame_idx_lists=[range(5), [0, 1, 2, 4]], chunk=2,
+                                      willneed_starts=[[86444, 168788], []]):
+    """pytest style test for read_spe.File.get_frames prefetching the next chunk with and without a memory map
+
+    """
+    for use_memmap in [True, False]:
+        spe = read_spe.File(fname=fname_spe, use_memmap=use_memmap)
+        # Record the advice given while still advising the kernel, including page alignment.
+        advice = []
+        advise_frames = spe._advise_frames
+        def record_advise_frames(option, start=None, length=None):
+            advice.append((option, start, length))
+            return advise_frames(option, start=start, length=length)
+        monkeypatch.setattr(spe, '_advise_frames', record_advise_frames)
+        for (frame_idx_list, starts) in zip(frame_idx_lists, willneed_starts):
+            del advice[:]
+            frames = np.concatenate([frames for (frames, metadata) in spe.get_frames(frame_idx_list, chunk=chunk)])
+            for (frame_num, frame_idx) in enumerate(frame_idx_list):
+                assert np.array_equal(frames[frame_num], spe.get_frame(frame_idx)[0])
+            # Only contiguous chunks from a memory map are prefetched.
+            if use_memmap:
+                assert [start for (option, start, length) in advice if option == 'MADV_WILLNEED'] == starts
+            else:
+                assert advice == []
+        spe.close()
+    return None
+
+
+def test_read_spe_get_frames_no_frames(fname_spe='tests/data/test_lightbox_10s_no_frames_no_footer 2014-05-20 21_56_08.spe'):
+    """pytest style test for read_spe.File.get_frames on a file with no frames
 
+    """
+    for use_memmap in [True, False]:
+        spe = read_spe.File(fname=fname_spe, use_memmap=use_memmap)
+        assert spe.get_num_frames() == 0
+        assert list(spe.get_frames([])) == []
+        with pytest.raises(IndexError):
+            list(spe.get_frames([0]))
+        spe.close()
+    return None
+
+
+def test_read_spe_iter_footer(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe',
+                              tag='{http://www.princetoninstruments.com/spe/2009}DataBlock'):
+    """pytest style test for read_spe.File.iter_footer
+
+    """
+    # Elements are kept after iteration and must not have been cleared.
+    data_blocks = list(read_spe.File(fname=fname_spe).iter_footer(tag))
+    assert [elt.attrib['type'] for elt in data_blocks] == ['Region', 'Frame']
+    assert data_blocks[0].attrib['width'] == '162'
+    assert data_blocks[0].attrib['height'] == '127'
+    assert data_blocks[1].attrib['count'] == '5'
+    assert data_blocks[1].attrib['stride'] == '41172'
+    # The Frame data block contains the Region data block.
+    assert [child.attrib['type'] for child in data_blocks[1]] == ['Region']
+    return None
+
+
+def test_read_spe_iter_footer_matches_xpath(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe',
+                                            ns={'exp': 'http://www.princetoninstruments.com/experiment/2009'}):
+    """pytest style test that read_spe.File.iter_footer yields the same elements as read_spe.File.footer_xpath
+
+    """
+    # Elements with these tags are repeated throughout the footer, including within each other.
+    spe = read_spe.File(fname=fname_spe)
+    for tag in ['Height', 'Enabled', 'ActiveArea']:
+        elts_iter = list(spe.iter_footer('{' + ns['exp'] + '}' + tag))
+        elts_xpath = spe.footer_xpath('//exp:' + tag, ns=ns)
+        assert len(elts_iter) == len(elts_xpath) > 1
+        for (elt_iter, elt_xpath) in zip(elts_iter, elts_xpath):
+            assert elt_iter.text == elt_xpath.text
+            assert dict(elt_iter.attrib) == dict(elt_xpath.attrib)
+            assert len(elt_iter) == len(elt_xpath)
+    return None
+
+
+def test_read_spe_get_frame_growing_file(tmpdir,
+                                         fname_spe='tests/data/test_lightbox_10s_no_footer 2014-05-20 21_56_08.spe'):
+    """pytest style test for read_spe.File.get_frame while frames are being written to the file
+
+    """
+    with open(fname_spe, 'rb') as fobj:
+        data = fobj.read()
+    with read_spe.File(fname=fname_spe) as spe:
+        start_offset = spe._get_start_offset()
+        bytes_per_stride = spe._get_bytes_per_stride()
+        (last_frame, last_metadata) = spe.get_frame(-1)
+    for use_memmap in [True, False]:
+        # Write the first 2 frames, open the file, then write the remaining frames.
+        fname_growing = str(tmpdir.join('growing_{use_memmap}.spe'.format(use_memmap=use_memmap)))
+        with open(fname_growing, 'wb') as fobj:
+            fobj.write(data[:start_offset + 2*bytes_per_stride])
+        spe = read_spe.File(fname=fname_growing, use_memmap=use_memmap)
+        assert spe.get_num_frames() == 2
+        with open(fname_growing, 'ab') as fobj:
+            fobj.write(data[start_offset + 2*bytes_per_stride:])
+        # Negative indexes count back from the last frame currently in the file.
+        (frame, metadata) = spe.get_frame(-1)
+        assert np.array_equal(frame, last_frame)
+        assert metadata == last_metadata
+        assert spe.get_num_frames() == 5
+        spe.close()
+    return None
+
+
+@pytest.mark.skipif(not hasattr(weakref, 'finalize'), reason="weakref.finalize requires Python 3.4+.")
+def test_read_spe_del_closes_file(fname_spe='tests/data/test_bias 2014-05-20 22_00_21.spe'):
+    """pytest style test that deleting a read_spe.File closes the file without garbage collection
+
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for use_memmap in [True, False]:
+            spe = read_spe.File(fname=fname_spe, use_memmap=use_memmap)
+            spe.get_frame(0)
+            fid = spe._fid
+            del spe
+            assert fid.closed
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return None
+
+
+def test_read_spe_context_manager(fname_spe='tests/data/test_bias 2014-05-20 22_00_21.spe'):
+    """pytest style test for read_spe.File.__enter__, read_spe.File.__exit__, and read_spe.File.close
+
+    """
+    with read_spe.File(fname=fname_spe) as spe:
+        assert isinstance(spe, read_spe.File)
+        assert not spe._fid.closed
+        spe.get_frame(0)
+        mm_ref = weakref.ref(spe._frame_mm)
+    # Closing releases the file and the memory map.
+    assert spe._fid.closed
+    assert spe._frames is None
+    assert mm_ref() is None
+    # Reading from a closed file raises ValueError with and without a memory map.
+    for use_memmap in [True, False]:
+        spe = read_spe.File(fname=fname_spe, use_memmap=use_memmap)
+        spe.close()
+        with pytest.raises(ValueError):
+            spe.get_frame(0)
+        with pytest.raises(ValueError):
+            list(spe.get_frames([0]))
+    # The file is closed if an exception is raised within the 'with' statement.
+    with pytest.raises(ValueError):
+        with read_spe.File(fname=fname_spe) as spe:
+            raise ValueError
+    assert spe._fid.closed
+    # Closing more than once is allowed.
+    spe.close()
+    return None
+
+
+def test_read_spe_get_frames_datetimes(fname_spe='tests/data/test_lightbox_10s 2014-05-20 21_56_08.spe'):
+    """pytest style test for time stamps from read_spe.File.get_frames as absolute time, UTC
+
+    """
+    # Convert time stamps as spe_process.main does: 1 tick = 1 microsecond from file creation time.
+    spe = read_spe.File(fname=fname_spe)
+    dt_fctime_abs = datetime.datetime.utcfromtimestamp(spe.get_file_ctime())
+    for (frames, metadata) in spe.get_frames(range(spe.get_num_frames())):
+        assert metadata["datetime_exposure_started"].dtype == np.dtype('datetime64[us]')
+        assert metadata["datetime_exposure_ended"].dtype == np.dtype('datetime64[us]')
+        for (frame_num, ticks) in enumerate(metadata["time_stamp_exposure_started"]):
+            dt_expstart_abs = dt_fctime_abs + datetime.timedelta(microseconds=int(ticks))
+            assert metadata["datetime_exposure_started"][frame_num].astype(datetime.datetime) == dt_expstart_abs
+        for (frame_num, ticks) in enumerate(metadata["time_stamp_exposure_ended"]):
+            dt_expend_abs = dt_fctime_abs + datetime.timedelta(microseconds=int(ticks))
+            assert metadata["datetime_exposure_ended"][frame_num].astype(datetime.datetime) == dt_expend_abs
+    spe.close()
+    return None